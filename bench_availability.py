@@ -0,0 +1,66 @@
+"""Бенчмарк поиска свободного времени: 10 мастеров × 30 дней.
+
+Запуск: python bench_availability.py
+Данные синтетические, файлы базы не изменяются.
+"""
+import atexit
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("VK_TOKEN", "bench")
+os.environ.setdefault("ADMIN_VK_ID", "1")
+
+import vk_bot
+
+atexit.unregister(vk_bot.save_all_data)
+
+MASTERS = 10
+DAYS = 30
+ROUNDS = 50
+
+
+def fill_synthetic_data():
+    random.seed(0)
+    service_keys = list(vk_bot.services_db)
+    vk_bot.masters_db.clear()
+    for i in range(MASTERS):
+        vk_bot.masters_db[f"m{i}"] = {
+            'name': f"Мастер {i}",
+            'start': 9 + i % 3,
+            'end': 19 + i % 3,
+            'weekdays': [d for d in range(7) if d != i % 7],
+            'services': random.sample(service_keys, 2)
+        }
+
+    vk_bot.appointments_db.clear()
+    today = datetime.now().date()
+    for day in range(DAYS):
+        date_key = (today + timedelta(days=day)).strftime("%Y-%m-%d")
+        times = vk_bot.appointments_db.setdefault(date_key, {})
+        for master_key in vk_bot.masters_db:
+            for hour in random.sample(range(10, 19), 4):
+                times.setdefault(f"{hour:02d}:00", {})[master_key] = {
+                    'user_id': 0,
+                    'service_key': random.choice(service_keys),
+                    'paid': True
+                }
+    return [today + timedelta(days=day) for day in range(DAYS)]
+
+
+def main():
+    dates = fill_synthetic_data()
+    print(f"Мастеров: {MASTERS}, дней: {DAYS}, записей: {vk_bot.count_appointments()}")
+
+    for service_key in vk_bot.services_db:
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            availability = vk_bot.get_availability(dates, service_key)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / ROUNDS
+        slots = sum(len(day) for day in availability.values())
+        print(f"{service_key:10s} {elapsed_ms:6.2f} мс на запрос, свободных слотов: {slots}")
+
+
+if __name__ == "__main__":
+    main()
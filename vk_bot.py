@@ -3,8 +3,12 @@ import logging
 import uuid
 import json
 import os
+import csv
+import re
+from itertools import islice
 from datetime import datetime, timedelta
 from collections import Counter
+import aiohttp
 from vkbottle.bot import Bot, Message
 from vkbottle import Keyboard, KeyboardButtonColor, Text
 from dotenv import load_dotenv
@@ -56,16 +60,22 @@ bot = Bot(token=VK_TOKEN)
 APPOINTMENTS_DB_FILE = "vk_appointments_db.json"
 USERS_DB_FILE = "vk_users_db.json"
 PENDING_PAYMENTS_FILE = "vk_pending_payments.json"
+EXPORTS_DIR = "exports"
+EXPORT_CHUNK_ROWS = 500
 
 users_db = {}
+# Записи: {дата: {время: {ключ мастера: запись}}}
 appointments_db = {}
 pending_payments = {}
+# Дневные сводки: {дата: {'count', 'revenue', 'services': {ключ услуги: {'count', 'revenue'}}}}
+# Хранятся только в памяти: строятся из appointments_db при запуске и дополняются в process_payment
+daily_rollups = {}
 user_states = {}
 
 
 # ========== ЗАГРУЗКА И СОХРАНЕНИЕ ==========
 def load_all_data():
-    global appointments_db, users_db, pending_payments
+    global appointments_db, users_db, pending_payments, daily_rollups
 
     def load_json(file_path, default):
         if os.path.exists(file_path):
@@ -76,11 +86,12 @@ def load_all_data():
                 return default
         return default
 
-    appointments_db = load_json(APPOINTMENTS_DB_FILE, {})
+    appointments_db = migrate_appointments(load_json(APPOINTMENTS_DB_FILE, {}))
     users_db = load_json(USERS_DB_FILE, {})
     pending_payments = load_json(PENDING_PAYMENTS_FILE, {})
+    daily_rollups = build_daily_rollups()
 
-    logger.info(f"✅ Загружено: {len(appointments_db)} записей, {len(users_db)} клиентов")
+    logger.info(f"✅ Загружено: {count_appointments()} записей, {len(users_db)} клиентов")
 
 
 def save_all_data():
@@ -92,14 +103,64 @@ def save_all_data():
         with open(PENDING_PAYMENTS_FILE, 'w', encoding='utf-8') as f:
             json.dump(pending_payments, f, ensure_ascii=False, indent=2, default=str)
 
-        total = sum(len(times) for times in appointments_db.values())
-        logger.info(f"💾 Сохранено: {total} записей, {len(users_db)} клиентов")
+        logger.info(f"💾 Сохранено: {count_appointments()} записей, {len(users_db)} клиентов")
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения: {e}")
 
 
-load_all_data()
-atexit.register(save_all_data)
+def migrate_appointments(data):
+    """Старый формат {дата: {время: запись}} переводит на мастера по умолчанию"""
+    for times in data.values():
+        for time_key, value in times.items():
+            if 'user_id' in value:
+                times[time_key] = {DEFAULT_MASTER: value}
+    return data
+
+
+def iter_appointments():
+    for date_key, times in appointments_db.items():
+        for time_key, masters in times.items():
+            for master_key, appt in masters.items():
+                yield date_key, time_key, master_key, appt
+
+
+def count_appointments():
+    return sum(len(masters) for times in appointments_db.values() for masters in times.values())
+
+
+# ========== ДНЕВНЫЕ СВОДКИ ==========
+def add_to_rollup(rollups, date_key, service_key, price):
+    day = rollups.setdefault(date_key, {'count': 0, 'revenue': 0, 'services': {}})
+    day['count'] += 1
+    day['revenue'] += price
+    service = day['services'].setdefault(service_key, {'count': 0, 'revenue': 0})
+    service['count'] += 1
+    service['revenue'] += price
+
+
+def build_daily_rollups():
+    """Пересчитывает сводки по всем оплаченным записям"""
+    rollups = {}
+    for date_key, _, _, appt in iter_appointments():
+        if appt.get('paid', False):
+            add_to_rollup(rollups, date_key, appt.get('service_key', ''), appt.get('price', 0))
+    return rollups
+
+
+def rollup_days(start_key=None, end_key=None):
+    """Дни со сводками в периоде [start_key, end_key] по возрастанию (None - без границы)"""
+    return sorted(
+        key for key in daily_rollups
+        if (start_key is None or key >= start_key) and (end_key is None or key <= end_key)
+    )
+
+
+def rollup_summary(start_key=None, end_key=None):
+    count = revenue = 0
+    for date_key in rollup_days(start_key, end_key):
+        count += daily_rollups[date_key]['count']
+        revenue += daily_rollups[date_key]['revenue']
+    return {'count': count, 'revenue': revenue}
 
 
 # ========== УСЛУГИ ==========
@@ -110,30 +171,258 @@ services_db = {
 }
 
 
+# ========== МАСТЕРА ==========
+# start/end - рабочие часы, weekdays - рабочие дни (0 = Пн), services - что умеет мастер.
+# Чтобы добавить мастера, допишите его сюда: запись распределяется автоматически.
+masters_db = {
+    'master': {
+        'name': 'Мастер',
+        'start': 10,
+        'end': 20,
+        'weekdays': [0, 1, 2, 3, 4, 5, 6],
+        'services': ['manicure', 'pedicure', 'cover']
+    }
+}
+DEFAULT_MASTER = next(iter(masters_db))
+
+load_all_data()
+atexit.register(save_all_data)
+
+
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
+SLOT_MINUTES = 30       # шаг сетки занятости
+SLOT_STEP_MINUTES = 60  # шаг времени начала записи
+SLOT_LABELS = [f"{m // 60:02d}:{m % 60:02d}" for m in range(0, 24 * 60, SLOT_MINUTES)]
+SLOT_INDEX = {label: i for i, label in enumerate(SLOT_LABELS)}
+
+
+def slots_count(minutes):
+    return -(-minutes // SLOT_MINUTES)
+
+
+def time_to_minutes(time_key):
+    index = SLOT_INDEX.get(time_key)
+    if index is not None:
+        return index * SLOT_MINUTES
+    try:
+        parsed = datetime.strptime(time_key, "%H:%M")
+    except (TypeError, ValueError):
+        return None
+    return parsed.hour * 60 + parsed.minute
+
+
+def master_name(master_key):
+    return masters_db.get(master_key, {}).get('name', master_key)
+
+
+def qualified_masters(service_key):
+    return [key for key, master in masters_db.items() if service_key in master['services']]
+
+
+def busy_masks(date_key):
+    """Занятость мастеров за день: {мастер: битовая маска слотов по SLOT_MINUTES}"""
+    masks = {}
+    for time_key, masters in appointments_db.get(date_key, {}).items():
+        start_minutes = time_to_minutes(time_key)
+        if start_minutes is None:
+            logger.warning(f"⚠️ Пропущена запись с неверным временем: {date_key} {time_key}")
+            continue
+        # Время вне сетки (например, 10:15) занимает все слоты, которые задевает
+        start = start_minutes // SLOT_MINUTES
+        for master_key, appt in masters.items():
+            duration = services_db.get(appt.get('service_key'), {}).get('duration', SLOT_MINUTES)
+            size = slots_count(start_minutes + duration) - start
+            appt_mask = ((1 << size) - 1) << start
+            masks[master_key] = masks.get(master_key, 0) | appt_mask
+    return masks
+
+
+def get_day_availability(date, service_key, masters=None):
+    """Свободное время на услугу за день: {время: [свободные мастера]}.
+    Записи дня просматриваются один раз для всех мастеров сразу."""
+    if masters is None:
+        masters = qualified_masters(service_key)
+
+    size = slots_count(services_db[service_key]['duration'])
+    service_mask = (1 << size) - 1
+    step = SLOT_STEP_MINUTES // SLOT_MINUTES
+    weekday = date.weekday()
+    busy = busy_masks(date.strftime("%Y-%m-%d"))
+
+    slots = {}
+    for master_key in masters:
+        master = masters_db[master_key]
+        if weekday not in master['weekdays']:
+            continue
+        master_busy = busy.get(master_key, 0)
+        first = master['start'] * 60 // SLOT_MINUTES
+        last = master['end'] * 60 // SLOT_MINUTES - size
+        for index in range(first, last + 1, step):
+            if not master_busy & (service_mask << index):
+                slots.setdefault(index, []).append(master_key)
+
+    return {SLOT_LABELS[index]: slots[index] for index in sorted(slots)}
+
+
+def get_availability(dates, service_key):
+    masters = qualified_masters(service_key)
+    return {date: get_day_availability(date, service_key, masters) for date in dates}
+
+
 def get_free_slots(date, service_key):
-    free_slots = []
-    service_duration = services_db[service_key]['duration']
-    current_time = datetime.combine(date, datetime.min.time()) + timedelta(hours=10)
-    end_time = datetime.combine(date, datetime.min.time()) + timedelta(hours=20)
-
-    while current_time + timedelta(minutes=service_duration) <= end_time:
-        time_str = current_time.strftime("%H:%M")
-        date_key = date.strftime("%Y-%m-%d")
-
-        is_free = True
-        for minute in range(0, service_duration, 30):
-            check_slot = (current_time + timedelta(minutes=minute)).strftime("%H:%M")
-            if appointments_db.get(date_key, {}).get(check_slot):
-                is_free = False
+    return list(get_day_availability(date, service_key))
+
+
+def pick_master(date, time_key, service_key):
+    """Из свободных в это время мастеров выбирает наименее загруженного за день"""
+    free_masters = get_day_availability(date, service_key).get(time_key)
+    if not free_masters:
+        return None
+
+    load = Counter(
+        master_key
+        for masters in appointments_db.get(date.strftime("%Y-%m-%d"), {}).values()
+        for master_key in masters
+    )
+    return min(free_masters, key=lambda master_key: load[master_key])
+
+
+# ========== ЭКСПОРТ ==========
+EXPORT_KINDS = {
+    '📆 По дням': 'days',
+    '💅 По услугам': 'services',
+    '📄 Все записи': 'bookings'
+}
+
+
+def rollup_service_totals(start_key, end_key):
+    totals = {}
+    for date_key in rollup_days(start_key, end_key):
+        for service_key, service in daily_rollups[date_key]['services'].items():
+            total = totals.setdefault(service_key, {'count': 0, 'revenue': 0})
+            total['count'] += service['count']
+            total['revenue'] += service['revenue']
+    return totals
+
+
+def rollup_day_totals(start_key, end_key):
+    return [
+        (date_key, daily_rollups[date_key]['count'], daily_rollups[date_key]['revenue'])
+        for date_key in rollup_days(start_key, end_key)
+    ]
+
+
+def iter_day_rows(day_totals):
+    yield ['Дата', 'Записей', 'Выручка']
+    for date_key, count, revenue in day_totals:
+        yield [date_key, count, revenue]
+
+
+def iter_service_rows(totals):
+    yield ['Услуга', 'Записей', 'Выручка']
+    for service_key in sorted(totals):
+        name = services_db.get(service_key, {}).get('name', service_key)
+        yield [name, totals[service_key]['count'], totals[service_key]['revenue']]
+
+
+def iter_booking_rows(date_keys):
+    yield ['Дата', 'Время', 'Мастер', 'Клиент', 'Телефон', 'Услуга', 'Цена', 'Оплачено', 'ID платежа']
+    for date_key in date_keys:
+        # Генератор работает в потоке: день копируется одним вызовом dict() (атомарно под GIL)
+        # и дальше обходится только копия, а не словарь, который может дополнить бот
+        times = dict(appointments_db.get(date_key, {}))
+        times = {time_key: dict(masters) for time_key, masters in times.items()}
+        for time_key in sorted(times):
+            for master_key, appt in times[time_key].items():
+                yield [
+                    date_key,
+                    time_key,
+                    master_name(master_key),
+                    appt.get('name', ''),
+                    appt.get('phone', ''),
+                    appt.get('service', ''),
+                    appt.get('price', 0),
+                    'да' if appt.get('paid', False) else 'нет',
+                    appt.get('payment_id', '')
+                ]
+
+
+def export_rows(kind, start_key, end_key):
+    """Собирает всё, что обходит общие словари, в цикле событий;
+    потоку остаётся только форматировать и писать строки"""
+    if kind == 'days':
+        return iter_day_rows(rollup_day_totals(start_key, end_key))
+    if kind == 'services':
+        return iter_service_rows(rollup_service_totals(start_key, end_key))
+    date_keys = sorted(key for key in appointments_db if start_key <= key <= end_key)
+    return iter_booking_rows(date_keys)
+
+
+def write_csv_chunks(file_path, rows):
+    """Пишет строки генератора в файл порциями по EXPORT_CHUNK_ROWS"""
+    written = 0
+    with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        while True:
+            chunk = list(islice(rows, EXPORT_CHUNK_ROWS))
+            if not chunk:
                 break
+            writer.writerows(chunk)
+            written += len(chunk)
+    return written
+
+
+def export_file_path(kind, start_date, end_date):
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    suffix = uuid.uuid4().hex[:8]
+    file_name = f"{kind}_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}_{suffix}.csv"
+    return os.path.join(EXPORTS_DIR, file_name)
+
+
+async def export_csv(file_path, kind, start_date, end_date):
+    rows = export_rows(kind, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+    written = await asyncio.to_thread(write_csv_chunks, file_path, rows)
+    logger.info(f"📤 Экспорт {file_path}: {written - 1} строк")
 
-        if is_free:
-            free_slots.append(time_str)
 
-        current_time += timedelta(minutes=60)
+async def upload_doc(file_path, peer_id):
+    """Загружает файл документом VK, отправляя его с диска частями, а не целиком из памяти"""
+    server = await bot.api.docs.get_messages_upload_server(type='doc', peer_id=peer_id)
+    file_name = os.path.basename(file_path)
 
-    return free_slots
+    async with aiohttp.ClientSession() as session:
+        with open(file_path, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('file', f, filename=file_name, content_type='text/csv')
+            async with session.post(server.upload_url, data=form) as response:
+                uploaded = await response.json(content_type=None)
+
+    if 'file' not in uploaded:
+        raise RuntimeError(f"VK не принял файл: {uploaded}")
+
+    saved = await bot.api.docs.save(file=uploaded['file'], title=file_name)
+    return f"doc{saved.doc.owner_id}_{saved.doc.id}"
+
+
+async def send_export_to_admin(file_path):
+    doc = await upload_doc(file_path, ADMIN_ID)
+    await bot.api.messages.send(
+        user_id=ADMIN_ID,
+        message="📤 Экспорт готов",
+        attachment=doc,
+        random_id=0
+    )
+
+
+def parse_period(text):
+    match = re.fullmatch(r'\s*(\d{2}\.\d{2}\.\d{4})\s*-\s*(\d{2}\.\d{2}\.\d{4})\s*', text)
+    if not match:
+        raise ValueError()
+    start_date = datetime.strptime(match.group(1), "%d.%m.%Y").date()
+    end_date = datetime.strptime(match.group(2), "%d.%m.%Y").date()
+    if start_date > end_date:
+        raise ValueError()
+    return start_date, end_date
 
 
 def create_payment_link(amount, label, comment):
@@ -167,10 +456,21 @@ def admin_keyboard():
     kb.add(Text("📅 Все записи"))
     kb.add(Text("👥 Клиенты"))
     kb.row()
+    kb.add(Text("📤 Экспорт"))
+    kb.row()
     kb.add(Text("⬅️ В меню"), color=KeyboardButtonColor.NEGATIVE)
     return kb.get_json()
 
 
+def export_kinds_keyboard():
+    kb = Keyboard(one_time=True)
+    for label in EXPORT_KINDS:
+        kb.add(Text(label))
+        kb.row()
+    kb.add(Text("⬅️ Назад"), color=KeyboardButtonColor.NEGATIVE)
+    return kb.get_json()
+
+
 def services_keyboard():
     kb = Keyboard(one_time=True)
     for key, service in services_db.items():
@@ -247,16 +547,16 @@ async def my_appointments(message: Message):
     user_id = message.from_id
     
     user_appts = []
-    for date_key, times in appointments_db.items():
-        for time_key, appt in times.items():
-            if appt.get('user_id') == user_id:
-                user_appts.append({
-                    'date': date_key,
-                    'time': time_key,
-                    'service': appt.get('service'),
-                    'price': appt.get('price'),
-                    'paid': appt.get('paid', False)
-                })
+    for date_key, time_key, master_key, appt in iter_appointments():
+        if appt.get('user_id') == user_id:
+            user_appts.append({
+                'date': date_key,
+                'time': time_key,
+                'master': master_name(master_key),
+                'service': appt.get('service'),
+                'price': appt.get('price'),
+                'paid': appt.get('paid', False)
+            })
     
     if not user_appts:
         await message.answer(
@@ -275,7 +575,7 @@ async def my_appointments(message: Message):
         
         text += (
             f"{i}. {date_display} в {appt['time']}\n"
-            f"   💅 {appt['service']}\n"
+            f"   💅 {appt['service']} ({appt['master']})\n"
             f"   💰 {appt['price']}₽ | {status}\n\n"
         )
     
@@ -287,24 +587,20 @@ async def stats_handler(message: Message):
     if message.from_id != ADMIN_ID:
         return
     
-    total_appts = sum(len(times) for times in appointments_db.values())
-    paid_appts = sum(
-        1 for times in appointments_db.values()
-        for appt in times.values()
-        if appt.get('paid', False)
-    )
-    revenue = sum(
-        appt.get('price', 0)
-        for times in appointments_db.values()
-        for appt in times.values()
-        if appt.get('paid', False)
+    total_appts = count_appointments()
+    paid = rollup_summary()
+    today = datetime.now().date()
+    month = rollup_summary(
+        today.replace(day=1).strftime("%Y-%m-%d"),
+        today.strftime("%Y-%m-%d")
     )
     
     text = (
         f"📊 Статистика:\n\n"
         f"📅 Всего записей: {total_appts}\n"
-        f"✅ Оплачено: {paid_appts}\n"
-        f"💰 Выручка: {revenue}₽\n"
+        f"✅ Оплачено: {paid['count']}\n"
+        f"💰 Выручка: {paid['revenue']}₽\n"
+        f"🗓 С начала месяца: {month['count']} / {month['revenue']}₽\n"
         f"👥 Клиентов: {len(users_db)}"
     )
     
@@ -326,9 +622,12 @@ async def all_appointments(message: Message):
         text += f"📆 {date_display}:\n"
         
         for time_key in sorted(appointments_db[date_key].keys()):
-            appt = appointments_db[date_key][time_key]
-            status = "✅" if appt.get('paid') else "⏳"
-            text += f"  {status} {time_key} - {appt['name']} ({appt['service']})\n"
+            for master_key, appt in appointments_db[date_key][time_key].items():
+                status = "✅" if appt.get('paid') else "⏳"
+                text += (
+                    f"  {status} {time_key} - {appt['name']} "
+                    f"({appt['service']}, {master_name(master_key)})\n"
+                )
         text += "\n"
     
     await message.answer(text, keyboard=admin_keyboard())
@@ -346,8 +645,7 @@ async def clients_handler(message: Message):
     text = f"👥 Всего клиентов: {len(users_db)}\n\n"
     for user_id, user_data in list(users_db.items())[:10]:
         appts_count = sum(
-            1 for times in appointments_db.values()
-            for appt in times.values()
+            1 for _, _, _, appt in iter_appointments()
             if str(appt.get('user_id')) == str(user_id)
         )
         text += f"👤 {user_data['name']} | 📞 {user_data['phone']} | 📅 {appts_count}\n"
@@ -355,6 +653,15 @@ async def clients_handler(message: Message):
     await message.answer(text, keyboard=admin_keyboard())
 
 
+@bot.on.message(text="📤 Экспорт")
+async def export_start(message: Message):
+    if message.from_id != ADMIN_ID:
+        return
+    
+    user_states[message.from_id] = {'step': 'export_kind'}
+    await message.answer("📤 Что выгрузить?", keyboard=export_kinds_keyboard())
+
+
 @bot.on.message(text="⬅️ В меню")
 async def back_to_menu(message: Message):
     user_id = message.from_id
@@ -384,7 +691,13 @@ async def message_handler(message: Message):
     
     # Назад
     if text == "⬅️ Назад":
-        if step == 'choose_service':
+        if step == 'export_kind':
+            del user_states[user_id]
+            await message.answer("🏠 Админ-панель:", keyboard=admin_keyboard())
+        elif step == 'export_period':
+            state['step'] = 'export_kind'
+            await message.answer("📤 Что выгрузить?", keyboard=export_kinds_keyboard())
+        elif step == 'choose_service':
             del user_states[user_id]
             await message.answer("🏠 Главное меню:", keyboard=main_keyboard())
         elif step == 'choose_date':
@@ -399,6 +712,47 @@ async def message_handler(message: Message):
             await message.answer("⏰ Выберите время:", keyboard=times_keyboard(free_slots))
         return
     
+    # Экспорт: тип отчёта
+    if step == 'export_kind':
+        if text not in EXPORT_KINDS:
+            await message.answer("❌ Выберите из списка:", keyboard=export_kinds_keyboard())
+            return
+        
+        state.update({'export_kind': EXPORT_KINDS[text], 'step': 'export_period'})
+        
+        kb = Keyboard(one_time=True)
+        kb.add(Text("⬅️ Назад"), color=KeyboardButtonColor.NEGATIVE)
+        
+        await message.answer(
+            "🗓 Введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ\n"
+            "Например: 01.01.2024-31.12.2024",
+            keyboard=kb.get_json()
+        )
+        return
+    
+    # Экспорт: период
+    if step == 'export_period':
+        try:
+            start_date, end_date = parse_period(text)
+        except ValueError:
+            await message.answer("❌ Неверный формат. Пример: 01.01.2024-31.12.2024")
+            return
+        
+        del user_states[user_id]
+        await message.answer("⏳ Готовлю файл...", keyboard=admin_keyboard())
+        
+        file_path = export_file_path(state['export_kind'], start_date, end_date)
+        try:
+            await export_csv(file_path, state['export_kind'], start_date, end_date)
+            await send_export_to_admin(file_path)
+        except Exception as e:
+            logger.error(f"Ошибка экспорта: {e}")
+            await message.answer("❌ Ошибка экспорта", keyboard=admin_keyboard())
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        return
+    
     # Выбор услуги
     if step == 'choose_service':
         for key, service in services_db.items():
@@ -583,6 +937,13 @@ async def process_payment(message: Message, payment_id: str):
         await message.answer("❌ Платёж не найден", keyboard=main_keyboard())
         return
     
+    if pending_payments[payment_id].get('status') == 'conflict':
+        await message.answer(
+            "⏳ Платёж уже передан администратору, он свяжется с вами.",
+            keyboard=main_keyboard()
+        )
+        return
+    
     try:
         payment_data = pending_payments[payment_id]
         
@@ -591,13 +952,47 @@ async def process_payment(message: Message, payment_id: str):
             date_key = date_obj.strftime("%Y-%m-%d")
         else:
             date_key = payment_data['date_obj']
+            date_obj = datetime.strptime(date_key, "%Y-%m-%d").date()
         
         time_key = payment_data['time']
         
-        if date_key not in appointments_db:
-            appointments_db[date_key] = {}
+        master_key = pick_master(date_obj, time_key, payment_data['service_key'])
+        if master_key is None:
+            # Оплата уже прошла: платёж оставляем, чтобы админ вернул деньги или перезаписал
+            payment_data['status'] = 'conflict'
+            save_all_data()
+            
+            admin_text = (
+                f"⚠️ Оплата без записи: время уже занято!\n\n"
+                f"👤 {payment_data['name']}\n"
+                f"📞 {payment_data['phone']}\n"
+                f"💅 {payment_data['service_name']}\n"
+                f"💰 {payment_data['price']}₽\n"
+                f"📅 {payment_data['date_display']} в {payment_data['time']}\n\n"
+                f"🆔 {payment_id}\n"
+                f"Нужен возврат или перенос записи."
+            )
+            
+            try:
+                await bot.api.messages.send(
+                    user_id=ADMIN_ID,
+                    message=admin_text,
+                    random_id=0
+                )
+            except Exception as e:
+                logger.error(f"Ошибка отправки админу: {e}")
+            
+            await message.answer(
+                "❌ Это время уже заняли.\n\n"
+                "💰 Оплата сохранена, администратор свяжется с вами "
+                "для переноса записи или возврата денег.\n"
+                f"🆔 ID: {payment_id}",
+                keyboard=main_keyboard()
+            )
+            return
         
-        appointments_db[date_key][time_key] = {
+        day = appointments_db.setdefault(date_key, {})
+        day.setdefault(time_key, {})[master_key] = {
             'user_id': payment_data['user_id'],
             'name': payment_data['name'],
             'phone': payment_data['phone'],
@@ -611,12 +1006,22 @@ async def process_payment(message: Message, payment_id: str):
             'payment_method': 'test'
         }
         
+        add_to_rollup(
+            daily_rollups,
+            date_key,
+            payment_data['service_key'],
+            payment_data['price']
+        )
+        
         users_db[str(payment_data['user_id'])] = {
             'name': payment_data['name'],
             'phone': payment_data['phone'],
             'last_appointment': datetime.now().isoformat()
         }
         
+        # Платёж закрываем до первого await: повторное нажатие «Я оплатил»
+        # не должно записать клиента второй раз
+        del pending_payments[payment_id]
         save_all_data()
         
         # Уведомление админу
@@ -625,6 +1030,7 @@ async def process_payment(message: Message, payment_id: str):
             f"👤 {payment_data['name']}\n"
             f"📞 {payment_data['phone']}\n"
             f"💅 {payment_data['service_name']}\n"
+            f"👩 {master_name(master_key)}\n"
             f"💰 {payment_data['price']}₽\n"
             f"📅 {payment_data['date_display']} в {payment_data['time']}\n\n"
             f"🆔 {payment_id}"
@@ -644,6 +1050,7 @@ async def process_payment(message: Message, payment_id: str):
             f"🎉 Запись успешно оплачена!\n\n"
             f"✅ Детали:\n"
             f"• {payment_data['service_name']}\n"
+            f"• Мастер: {master_name(master_key)}\n"
             f"• {payment_data['price']}₽\n"
             f"• {payment_data['date_display']} в {payment_data['time']}\n\n"
             f"📍 Адрес: ул. Примерная, д. 1\n"
@@ -653,9 +1060,6 @@ async def process_payment(message: Message, payment_id: str):
         
         await message.answer(success_text, keyboard=main_keyboard())
         
-        del pending_payments[payment_id]
-        save_all_data()
-        
     except Exception as e:
         logger.error(f"Ошибка обработки оплаты: {e}")
         await message.answer("❌ Ошибка. Попробуйте ещё раз.", keyboard=main_keyboard())
@@ -666,7 +1070,8 @@ async def main():
     logger.info("=" * 60)
     logger.info("✨ VK БОТ ЗАПУЩЕН ✨")
     logger.info(f"👑 Админ: {ADMIN_ID}")
-    logger.info(f"📊 Записей: {sum(len(times) for times in appointments_db.values())}")
+    logger.info(f"👩 Мастеров: {len(masters_db)}")
+    logger.info(f"📊 Записей: {count_appointments()}")
     logger.info("=" * 60)
     
     await bot.run_polling()